@@ -13,17 +13,41 @@ Design principles:
 - Zero traffic to disabled/flagged accounts
 """
 
+import heapq
+import itertools
 import json
 import logging
 import os
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows: appends to the onboarding cache are not locked
+    fcntl = None
+
+import requests
+from google.oauth2.credentials import Credentials
+from requests.adapters import HTTPAdapter
+
 logger = logging.getLogger(__name__)
 
+# Period over which an account's token bucket refills by max_rpm tokens
+RATE_WINDOW_SECONDS = 60.0
+# A capacity of one token (leaky bucket) means idle time cannot be saved up
+# into a burst, so no RATE_WINDOW_SECONDS window ever holds more than max_rpm
+BUCKET_CAPACITY = 1.0
+
+# Onboarded accounts are cached in the credentials directory across restarts,
+# one "email<TAB>unix_timestamp" per line, and re-checked after the TTL
+ONBOARDED_CACHE_FILE = ".onboarded"
+ONBOARDED_TTL_SECONDS = 24 * 3600
+
 
 @dataclass
 class AccountState:
@@ -33,63 +57,148 @@ class AccountState:
     credentials: dict
     project_id: str
     
-    # Rate tracking
-    request_timestamps: list = field(default_factory=list)
+    # Rate tracking (token bucket of BUCKET_CAPACITY refilled at max_rpm/minute)
+    max_rpm: int = 10
+    tokens: float = BUCKET_CAPACITY
+    last_refill: float = 0.0  # time.monotonic()
+    last_request_time: float = float("-inf")  # time.monotonic()
+    # Grant times for reporting only; at most max_rpm fall inside one window
+    recent_requests: deque = field(init=False, repr=False, compare=False)
     total_requests: int = 0
     total_errors: int = 0
     
     # Health
     is_healthy: bool = True
-    cooldown_until: float = 0.0  # Unix timestamp
+    cooldown_until: float = 0.0  # time.monotonic()
     consecutive_errors: int = 0
     last_error: Optional[str] = None
     
-    @property
-    def is_available(self) -> bool:
-        """Account is available if healthy and not in cooldown."""
-        return self.is_healthy and time.time() > self.cooldown_until
+    # Guards the multi-field updates below
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    
+    # Parsed credentials, rebuilt only on first use or after a reload
+    creds: Optional[Credentials] = field(default=None, repr=False, compare=False)
+    creds_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # (access token, headers) for Code Assist calls, rebuilt when the token changes
+    request_headers: Optional[tuple[str, dict]] = field(default=None, repr=False, compare=False)
+    
+    # Pooled HTTP connections for this account's token refreshes and onboarding
+    session: requests.Session = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.recent_requests = deque(maxlen=self.max_rpm)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_rpm)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
     
-    def requests_in_window(self, window_seconds: float = 60.0) -> int:
-        """Count requests in the last N seconds."""
-        cutoff = time.time() - window_seconds
-        # Clean old timestamps while counting
-        self.request_timestamps = [t for t in self.request_timestamps if t > cutoff]
-        return len(self.request_timestamps)
+    def is_available(self, now: float) -> bool:
+        """Account is available if healthy and not in cooldown at `now`."""
+        return self.is_healthy and now > self.cooldown_until
+    
+    def _tokens_at(self, now: float) -> float:
+        """Token count at `now`, refilled at max_rpm per RATE_WINDOW_SECONDS."""
+        refill = (now - self.last_refill) * self.max_rpm / RATE_WINDOW_SECONDS
+        return min(BUCKET_CAPACITY, self.tokens + refill)
+    
+    def tokens_in_use(self, now: float) -> float:
+        """
+        Bucket deficit at `now` (BUCKET_CAPACITY minus available tokens),
+        without refilling the bucket. It drains linearly, so it is not a
+        request count; see requests_in_window() for that.
+        """
+        return BUCKET_CAPACITY - self._tokens_at(now)
+    
+    def requests_in_window(self, now: float) -> int:
+        """Requests granted in the RATE_WINDOW_SECONDS before `now` (read-only)."""
+        cutoff = now - RATE_WINDOW_SECONDS
+        count = 0
+        for granted in reversed(self.recent_requests):
+            if granted <= cutoff:
+                break
+            count += 1
+        return count
+    
+    def try_acquire(self, gap_seconds: float, now: float) -> bool:
+        """
+        Take one token if the bucket has one and the last request was at
+        least gap_seconds before `now`. Check and take happen under the
+        account lock.
+        """
+        with self.lock:
+            tokens = self._tokens_at(now)
+            self.tokens, self.last_refill = tokens, now
+            
+            if tokens < 1.0:
+                logger.debug(f"Account {self.email} at RPM limit ({self.max_rpm})")
+                return False
+            if now - self.last_request_time < gap_seconds:
+                logger.debug(f"Account {self.email} within min gap ({gap_seconds}s)")
+                return False
+            
+            self.tokens -= 1.0
+            self.last_request_time = now
+            self.recent_requests.append(now)
+            return True
     
     def record_request(self):
         """Record a successful request."""
-        now = time.time()
-        self.request_timestamps.append(now)
-        self.total_requests += 1
-        self.consecutive_errors = 0
+        with self.lock:
+            self.total_requests += 1
+            self.consecutive_errors = 0
     
     def record_error(self, error_msg: str, is_rate_limit: bool = False):
         """Record an error and apply cooldown if needed."""
-        self.total_errors += 1
-        self.consecutive_errors += 1
-        self.last_error = error_msg
+        with self.lock:
+            self.total_errors += 1
+            self.consecutive_errors += 1
+            self.last_error = error_msg
+            
+            if is_rate_limit:
+                # Exponential backoff: 30s, 60s, 120s, 300s max
+                backoff = min(30 * (2 ** (self.consecutive_errors - 1)), 300)
+                self.cooldown_until = time.monotonic() + backoff
+            elif self.consecutive_errors >= 5:
+                # 5 consecutive non-rate-limit errors = disable account
+                self.is_healthy = False
         
         if is_rate_limit:
-            # Exponential backoff: 30s, 60s, 120s, 300s max
-            backoff = min(30 * (2 ** (self.consecutive_errors - 1)), 300)
-            self.cooldown_until = time.time() + backoff
             logger.warning(
                 f"Account {self.email} rate-limited. Cooldown {backoff}s "
                 f"(consecutive errors: {self.consecutive_errors})"
             )
-        elif self.consecutive_errors >= 5:
-            # 5 consecutive non-rate-limit errors = disable account
-            self.is_healthy = False
+        elif not self.is_healthy:
             logger.error(f"Account {self.email} disabled after {self.consecutive_errors} consecutive errors")
 
 
+def _parse_credential_file(cred_file: Path, max_rpm: int) -> Optional[AccountState]:
+    """Read a credential file into an AccountState, or None if it is unusable."""
+    with open(cred_file) as f:
+        creds = json.load(f)
+    
+    if not creds.get("refresh_token"):
+        logger.warning(f"Skipping {cred_file.name}: no refresh_token")
+        return None
+    
+    # Extract email from filename (name_at_domain_ext.json)
+    email = cred_file.stem.replace("_at_", "@").replace("_", ".")
+    
+    return AccountState(
+        email=email,
+        credential_path=str(cred_file),
+        credentials=creds,
+        project_id=creds.get("project_id", ""),
+        max_rpm=max_rpm,
+    )
+
+
 class AccountRotator:
     """
     Strategic multi-account rotation with rate limiting.
     
     Configuration via environment variables:
     - CREDENTIALS_DIR: Path to directory with credential JSON files (default: ./credentials)
-    - MAX_RPM_PER_ACCOUNT: Max requests per minute per account (default: 10)
+    - MAX_RPM_PER_ACCOUNT: Max requests per minute per account, spaced evenly (default: 10)
     - MIN_REQUEST_GAP_MS: Minimum milliseconds between requests to same account (default: 2000)
     """
     
@@ -104,10 +213,25 @@ class AccountRotator:
         self.min_gap_s = (min_request_gap_ms or int(os.getenv("MIN_REQUEST_GAP_MS", "2000"))) / 1000.0
         
         self.accounts: list[AccountState] = []
-        self._current_index = 0
-        self._lock = threading.Lock()
+        # Round-robin position. The lock guards only the increment, so it also
+        # holds on free-threaded builds where next() on a count is not atomic.
+        self._counter = itertools.count()
+        self._index_lock = threading.Lock()
+        
+        # Availability pool, maintained on errors instead of rescanned per call.
+        # _active is replaced (never mutated in place) so readers need no lock.
+        self._active: list[AccountState] = []
+        self._cooldown_heap: list[tuple[float, int, AccountState]] = []
+        self._disabled: set[str] = set()
+        self._heap_seq = itertools.count()  # Tie-breaker, AccountState is not orderable
+        self._pool_lock = threading.Lock()
+        
+        # Onboarding cache: email -> when onboarding was last confirmed
+        self._onboarded: dict[str, float] = {}
         
         self._load_accounts()
+        self._active = list(self.accounts)
+        self._load_onboarded()
     
     def _load_accounts(self):
         """Load all credential files from the credentials directory."""
@@ -116,36 +240,107 @@ class AccountRotator:
             logger.warning(f"Credentials directory not found: {self.credentials_dir}")
             return
         
-        for cred_file in sorted(cred_path.glob("*.json")):
-            try:
-                with open(cred_file) as f:
-                    creds = json.load(f)
-                
-                if not creds.get("refresh_token"):
-                    logger.warning(f"Skipping {cred_file.name}: no refresh_token")
+        cred_files = sorted(cred_path.glob("*.json"))
+        if cred_files:
+            # Reading and parsing is I/O bound, so load files concurrently
+            with ThreadPoolExecutor(max_workers=min(32, len(cred_files))) as executor:
+                futures = {executor.submit(_parse_credential_file, f, self.max_rpm): f for f in cred_files}
+                results = {}
+                for future in as_completed(futures):
+                    cred_file = futures[future]
+                    try:
+                        results[cred_file] = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to load {cred_file}: {e}")
+            
+            # Keep the sorted file order regardless of completion order
+            for cred_file in cred_files:
+                account = results.get(cred_file)
+                if account is None:
                     continue
-                
-                # Extract email from filename (name_at_domain_ext.json)
-                email = cred_file.stem.replace("_at_", "@").replace("_", ".")
-                
-                account = AccountState(
-                    email=email,
-                    credential_path=str(cred_file),
-                    credentials=creds,
-                    project_id=creds.get("project_id", ""),
-                )
                 self.accounts.append(account)
-                logger.info(f"Loaded account: {email} (project: {account.project_id})")
-                
-            except Exception as e:
-                logger.error(f"Failed to load {cred_file}: {e}")
+                logger.info(f"Loaded account: {account.email} (project: {account.project_id})")
         
         logger.info(f"Account rotator initialized: {len(self.accounts)} accounts, {self.max_rpm} RPM/account")
     
+    def _load_onboarded(self):
+        """
+        Read the persisted onboarding cache, dropping expired entries. When
+        expired, duplicate or malformed lines are found, the file is rewritten
+        with only the live entries so it does not grow without bound.
+        """
+        cache_path = Path(self.credentials_dir) / ONBOARDED_CACHE_FILE
+        try:
+            with open(cache_path, "r+") as f:
+                # Same lock as mark_onboarded(), so no append lands mid-rewrite
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                lines = f.readlines()
+                
+                cutoff = time.time() - ONBOARDED_TTL_SECONDS
+                for line in lines:
+                    email, _, timestamp = line.strip().partition("\t")
+                    try:
+                        timestamp = float(timestamp)
+                    except ValueError:
+                        continue
+                    if timestamp > max(cutoff, self._onboarded.get(email, 0.0)):
+                        self._onboarded[email] = timestamp
+                
+                if len(lines) != len(self._onboarded):
+                    f.seek(0)
+                    f.truncate()
+                    f.writelines(f"{email}\t{timestamp}\n" for email, timestamp in self._onboarded.items())
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Failed to read onboarding cache {cache_path}: {e}")
+            return
+        
+        if self._onboarded:
+            logger.info(f"Loaded onboarding cache: {len(self._onboarded)} accounts")
+    
+    def is_onboarded(self, email: str) -> bool:
+        """Whether the account was onboarded within the cache TTL."""
+        timestamp = self._onboarded.get(email)
+        return timestamp is not None and time.time() - timestamp < ONBOARDED_TTL_SECONDS
+    
+    def mark_onboarded(self, email: str):
+        """Record a confirmed onboarding in memory and in the on-disk cache."""
+        now = time.time()
+        self._onboarded[email] = now
+        
+        cache_path = Path(self.credentials_dir) / ONBOARDED_CACHE_FILE
+        try:
+            with open(cache_path, "a") as f:
+                # Several workers may share the directory; the lock is released on close
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(f"{email}\t{now}\n")
+        except OSError as e:
+            logger.warning(f"Failed to update onboarding cache {cache_path}: {e}")
+    
+    def _release_cooldowns(self, now: float):
+        """Move accounts whose cooldown has expired back into the active pool."""
+        heap = self._cooldown_heap
+        if not heap or heap[0][0] > now:
+            return
+        with self._pool_lock:
+            active = self._active
+            while heap and heap[0][0] <= now:
+                _, _, account = heapq.heappop(heap)
+                # Stale entry: the cooldown was extended and pushed again
+                if account.cooldown_until > now or account.email in self._disabled:
+                    continue
+                if not any(a is account for a in active):
+                    active = active + [account]
+            self._active = active
+    
     @property
     def available_accounts(self) -> list[AccountState]:
-        """Get list of currently available accounts."""
-        return [a for a in self.accounts if a.is_available]
+        """Get list of currently available accounts (shared; do not mutate)."""
+        self._release_cooldowns(time.monotonic())
+        return self._active
     
     def get_next_account(self) -> Optional[AccountState]:
         """
@@ -153,32 +348,28 @@ class AccountRotator:
         
         Returns None if all accounts are exhausted or in cooldown.
         """
-        with self._lock:
-            available = self.available_accounts
-            if not available:
-                logger.warning("No accounts available — all in cooldown or disabled")
-                return None
+        # One clock read for all cooldown, refill and gap checks in this call
+        now = time.monotonic()
+        self._release_cooldowns(now)
+        available = self._active
+        count = len(available)
+        if not count:
+            logger.warning("No accounts available — all in cooldown or disabled")
+            return None
+        
+        # Only the index increment is locked. The active list is replaced rather
+        # than mutated, and per-account checks take the account's own lock.
+        with self._index_lock:
+            start = next(self._counter)
+        for i in range(count):
+            account = available[(start + i) % count]
             
-            # Try each available account starting from current index
-            for _ in range(len(available)):
-                account = available[self._current_index % len(available)]
-                self._current_index = (self._current_index + 1) % len(available)
-                
-                # Check per-minute rate limit
-                if account.requests_in_window(60.0) >= self.max_rpm:
-                    logger.debug(f"Account {account.email} at RPM limit ({self.max_rpm})")
-                    continue
-                
-                # Check minimum gap between requests
-                recent = account.requests_in_window(self.min_gap_s)
-                if recent > 0:
-                    logger.debug(f"Account {account.email} within min gap ({self.min_gap_s}s)")
-                    continue
-                
+            # Checks the RPM limit and minimum gap, and takes a token if both pass
+            if account.try_acquire(self.min_gap_s, now):
                 return account
-            
-            logger.warning("All accounts at rate limit — consider reducing request volume")
-            return None
+        
+        logger.warning("All accounts at rate limit — consider reducing request volume")
+        return None
     
     def record_success(self, account: AccountState):
         """Record a successful request for an account."""
@@ -188,23 +379,37 @@ class AccountRotator:
         """Record an error for an account."""
         is_rate_limit = status_code in (429, 503)
         account.record_error(error_msg, is_rate_limit=is_rate_limit)
+        
+        if is_rate_limit or not account.is_healthy:
+            with self._pool_lock:
+                self._active = [a for a in self._active if a is not account]
+                if not account.is_healthy:
+                    self._disabled.add(account.email)
+                else:
+                    heapq.heappush(
+                        self._cooldown_heap,
+                        (account.cooldown_until, next(self._heap_seq), account),
+                    )
     
     def get_stats(self) -> dict:
         """Get rotation statistics for monitoring."""
+        # Read-only snapshot: one clock read, no token refills or pool updates
+        now = time.monotonic()
         return {
             "total_accounts": len(self.accounts),
-            "available_accounts": len(self.available_accounts),
+            "available_accounts": sum(a.is_available(now) for a in self.accounts),
             "max_rpm_per_account": self.max_rpm,
             "min_request_gap_ms": int(self.min_gap_s * 1000),
             "accounts": [
                 {
                     "email": a.email,
-                    "is_available": a.is_available,
+                    "is_available": a.is_available(now),
                     "is_healthy": a.is_healthy,
                     "total_requests": a.total_requests,
                     "total_errors": a.total_errors,
-                    "rpm_current": a.requests_in_window(60.0),
-                    "cooldown_remaining": max(0, a.cooldown_until - time.time()),
+                    "rpm_current": a.requests_in_window(now),
+                    "tokens_in_use": round(a.tokens_in_use(now), 2),
+                    "cooldown_remaining": max(0, a.cooldown_until - now),
                     "consecutive_errors": a.consecutive_errors,
                 }
                 for a in self.accounts
@@ -218,6 +423,7 @@ class AccountRotator:
                 with open(account.credential_path) as f:
                     creds = json.load(f)
                 account.credentials = creds
+                account.creds = None
                 logger.info(f"Reloaded credentials for {account.email}")
             except Exception as e:
                 logger.error(f"Failed to reload credentials for {account.email}: {e}")
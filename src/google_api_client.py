@@ -10,7 +10,7 @@ from fastapi.responses import StreamingResponse
 from google.auth.transport.requests import Request as GoogleAuthRequest
 
 from .auth import get_credentials, save_credentials, get_user_project_id, onboard_user
-from .utils import get_user_agent
+from .utils import get_user_agent, dumps_json
 from .config import (
     CODE_ASSIST_ENDPOINT,
     DEFAULT_SAFETY_SETTINGS,
@@ -21,6 +21,15 @@ from .config import (
 )
 import asyncio
 
+# SSE framing, joined around serialized bytes so each event costs no str formatting
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
+
+def _sse_event(obj) -> bytes:
+    """Format one SSE event, escaping lone surrogates that orjson rejects."""
+    return _SSE_PREFIX + dumps_json(obj) + _SSE_SUFFIX
+
 
 def send_gemini_request(payload: dict, is_streaming: bool = False) -> Response:
     """
@@ -168,14 +177,10 @@ def _handle_streaming_response(resp) -> StreamingResponse:
                                 obj = json.loads(chunk)
                                 
                                 if "response" in obj:
-                                    response_chunk = obj["response"]
-                                    response_json = json.dumps(response_chunk, separators=(',', ':'))
-                                    response_line = f"data: {response_json}\n\n"
-                                    yield response_line.encode('utf-8', "ignore")
+                                    yield _sse_event(obj["response"])
                                     await asyncio.sleep(0)
                                 else:
-                                    obj_json = json.dumps(obj, separators=(',', ':'))
-                                    yield f"data: {obj_json}\n\n".encode('utf-8', "ignore")
+                                    yield _sse_event(obj)
                             except json.JSONDecodeError:
                                 continue
                 
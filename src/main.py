@@ -91,6 +91,19 @@ async def startup_event():
     except Exception as e:
         logging.error(f"Startup error: {str(e)}")
         logging.warning("Server may not function properly.")
+    
+    # Onboard rotator accounts before serving traffic
+    try:
+        from starlette.concurrency import run_in_threadpool
+        from .rotated_client import warm_up_accounts
+        await run_in_threadpool(warm_up_accounts)
+    except Exception as e:
+        logging.error(f"Account warm-up error: {str(e)}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    from .rotated_client import aclose_http_client
+    await aclose_http_client()
 
 @app.options("/{full_path:path}")
 async def handle_preflight(request: Request, full_path: str):
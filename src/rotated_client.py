@@ -7,72 +7,111 @@ Each request gets fresh credentials from the next available account.
 
 import json
 import logging
-import requests as http_requests
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+import orjson
 from fastapi import Response
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request as GoogleAuthRequest
 
 from .account_rotator import get_rotator, AccountState
-from .utils import get_user_agent, get_client_metadata
+from .utils import get_user_agent, get_client_metadata, loads_json, dumps_json
 from .config import (
     CODE_ASSIST_ENDPOINT, SCOPES,
     DEFAULT_SAFETY_SETTINGS,
     get_base_model_name, is_search_model,
     get_thinking_budget, should_include_thoughts,
 )
-import asyncio
 
 logger = logging.getLogger(__name__)
 
-# Cache onboarding status per account
-_onboarded_accounts: set[str] = set()
+# SSE framing, joined around the payload bytes with no str formatting
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
+# Shared async client for generate calls, so streams never block the event loop
+_async_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200),
+    timeout=httpx.Timeout(None, connect=10.0),
+)
+
+
+async def aclose_http_client():
+    """Close the shared async HTTP client (called on app shutdown)."""
+    await _async_client.aclose()
 
 
 def _get_google_credentials(account: AccountState) -> Credentials | None:
-    """Create and refresh Google Credentials from account data."""
-    creds_data = account.credentials
+    """Get cached Google Credentials for the account, refreshing when expired."""
+    creds = account.creds
+    if creds is not None and creds.valid:
+        return creds
     
-    try:
-        creds = Credentials.from_authorized_user_info(creds_data, SCOPES)
-    except Exception as e:
-        logger.error(f"Failed to create credentials for {account.email}: {e}")
-        return None
-    
-    # Refresh if expired
-    if creds.expired and creds.refresh_token:
-        try:
-            creds.refresh(GoogleAuthRequest())
-            # Update stored token for next time
-            account.credentials["token"] = creds.token
-            if creds.expiry:
-                from datetime import timezone
-                if creds.expiry.tzinfo is None:
-                    expiry_utc = creds.expiry.replace(tzinfo=timezone.utc)
-                else:
-                    expiry_utc = creds.expiry
-                account.credentials["expiry"] = expiry_utc.isoformat()
-            logger.debug(f"Refreshed credentials for {account.email}")
-        except Exception as e:
-            logger.error(f"Failed to refresh credentials for {account.email}: {e}")
+    with account.creds_lock:
+        # Another thread may have refreshed while we waited
+        creds = account.creds
+        if creds is not None and creds.valid:
+            return creds
+        
+        if creds is None:
+            try:
+                creds = Credentials.from_authorized_user_info(account.credentials, SCOPES)
+            except Exception as e:
+                logger.error(f"Failed to create credentials for {account.email}: {e}")
+                return None
+            account.creds = creds
+        
+        # Refresh if expired
+        if creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(GoogleAuthRequest(session=account.session))
+                # Update stored token for next time
+                account.credentials["token"] = creds.token
+                if creds.expiry:
+                    from datetime import timezone
+                    if creds.expiry.tzinfo is None:
+                        expiry_utc = creds.expiry.replace(tzinfo=timezone.utc)
+                    else:
+                        expiry_utc = creds.expiry
+                    account.credentials["expiry"] = expiry_utc.isoformat()
+                logger.debug(f"Refreshed credentials for {account.email}")
+            except Exception as e:
+                logger.error(f"Failed to refresh credentials for {account.email}: {e}")
+                return None
+        elif not creds.token:
+            logger.error(f"No access token for {account.email}")
             return None
-    elif not creds.token:
-        logger.error(f"No access token for {account.email}")
-        return None
-    
-    return creds
+        
+        return creds
 
 
-def _ensure_onboarded(creds: Credentials, project_id: str, account_email: str) -> bool:
-    """Ensure the account is onboarded with Code Assist."""
-    if account_email in _onboarded_accounts:
-        return True
-    
+def _get_request_headers(account: AccountState, creds: Credentials) -> dict:
+    """Get the account's request headers, reusing them until the token rotates."""
+    cached = account.request_headers
+    if cached is not None and cached[0] == creds.token:
+        return cached[1]
     headers = {
         "Authorization": f"Bearer {creds.token}",
         "Content-Type": "application/json",
         "User-Agent": get_user_agent(),
     }
+    account.request_headers = (creds.token, headers)
+    return headers
+
+
+def _ensure_onboarded(creds: Credentials, account: AccountState) -> bool:
+    """Ensure the account is onboarded with Code Assist."""
+    account_email = account.email
+    project_id = account.project_id
+    rotator = get_rotator()
+    if rotator.is_onboarded(account_email):
+        return True
+    
+    headers = _get_request_headers(account, creds)
     
     load_payload = {
         "cloudaicompanionProject": project_id,
@@ -80,9 +119,9 @@ def _ensure_onboarded(creds: Credentials, project_id: str, account_email: str) -
     }
     
     try:
-        resp = http_requests.post(
+        resp = account.session.post(
             f"{CODE_ASSIST_ENDPOINT}/v1internal:loadCodeAssist",
-            data=json.dumps(load_payload),
+            data=orjson.dumps(load_payload),
             headers=headers,
             timeout=10,
         )
@@ -90,7 +129,7 @@ def _ensure_onboarded(creds: Credentials, project_id: str, account_email: str) -
         data = resp.json()
         
         if data.get("currentTier"):
-            _onboarded_accounts.add(account_email)
+            rotator.mark_onboarded(account_email)
             return True
         
         # Need to onboard
@@ -113,14 +152,14 @@ def _ensure_onboarded(creds: Credentials, project_id: str, account_email: str) -
             "metadata": get_client_metadata(project_id),
         }
         
-        onboard_resp = http_requests.post(
+        onboard_resp = account.session.post(
             f"{CODE_ASSIST_ENDPOINT}/v1internal:onboardUser",
-            data=json.dumps(onboard_payload),
+            data=orjson.dumps(onboard_payload),
             headers=headers,
             timeout=30,
         )
         onboard_resp.raise_for_status()
-        _onboarded_accounts.add(account_email)
+        rotator.mark_onboarded(account_email)
         return True
         
     except Exception as e:
@@ -128,7 +167,38 @@ def _ensure_onboarded(creds: Credentials, project_id: str, account_email: str) -
         return False
 
 
-def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
+def warm_up_accounts():
+    """
+    Onboard every rotator account up front, in parallel, so that the first
+    request per account does not pay for the Code Assist onboarding calls.
+    Failures are recorded as ordinary errors; the account stays in rotation
+    and onboarding is retried lazily on its first request.
+    """
+    rotator = get_rotator()
+    pending = [a for a in rotator.accounts if not rotator.is_onboarded(a.email)]
+    if not pending:
+        return
+    
+    def onboard(account: AccountState) -> bool:
+        creds = _get_google_credentials(account)
+        return creds is not None and _ensure_onboarded(creds, account)
+    
+    with ThreadPoolExecutor(max_workers=min(32, len(pending))) as executor:
+        futures = {executor.submit(onboard, a): a for a in pending}
+        for future in as_completed(futures):
+            account = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                logger.error(f"Warm-up failed for {account.email}: {e}")
+                ok = False
+            if not ok:
+                rotator.record_error(account, 403, "Onboarding failed at startup")
+    
+    logger.info(f"Account warm-up complete: {len(pending)} accounts checked")
+
+
+async def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
     """
     Send a request using the next available account from the rotation pool.
     Falls back to single-account mode if no rotator accounts are available.
@@ -139,12 +209,12 @@ def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
     if not rotator.accounts:
         logger.warning("No rotator accounts — falling back to single-account mode")
         from .google_api_client import send_gemini_request
-        return send_gemini_request(payload, is_streaming)
+        return await run_in_threadpool(send_gemini_request, payload, is_streaming)
     
     account = rotator.get_next_account()
     if account is None:
         return Response(
-            content=json.dumps({
+            content=orjson.dumps({
                 "error": {
                     "message": "All accounts exhausted or in cooldown. Try again later.",
                     "type": "rate_limit_error",
@@ -155,30 +225,33 @@ def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
             media_type="application/json",
         )
     
-    logger.info(f"Routing request to {account.email} (RPM: {account.requests_in_window()}/{rotator.max_rpm})")
+    logger.info(
+        f"Routing request to {account.email} "
+        f"(RPM: {account.requests_in_window(time.monotonic())}/{rotator.max_rpm})"
+    )
     
-    # Get credentials
-    creds = _get_google_credentials(account)
+    # Credential refresh and onboarding are rare blocking calls; keep them off the loop
+    creds = await run_in_threadpool(_get_google_credentials, account)
     if not creds:
         rotator.record_error(account, 500, "Failed to get credentials")
         # Try next account
         account2 = rotator.get_next_account()
         if account2:
-            creds = _get_google_credentials(account2)
+            creds = await run_in_threadpool(_get_google_credentials, account2)
             account = account2
         if not creds:
             return Response(
-                content=json.dumps({"error": {"message": "Authentication failed for all accounts"}}),
+                content=orjson.dumps({"error": {"message": "Authentication failed for all accounts"}}),
                 status_code=500,
                 media_type="application/json",
             )
     
     # Ensure onboarded
     project_id = account.project_id
-    if not _ensure_onboarded(creds, project_id, account.email):
+    if not await run_in_threadpool(_ensure_onboarded, creds, account):
         rotator.record_error(account, 403, "Onboarding failed")
         return Response(
-            content=json.dumps({"error": {"message": f"Onboarding failed for {account.email}"}}),
+            content=orjson.dumps({"error": {"message": f"Onboarding failed for {account.email}"}}),
             status_code=500,
             media_type="application/json",
         )
@@ -195,30 +268,28 @@ def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
     if is_streaming:
         target_url += "?alt=sse"
     
-    request_headers = {
-        "Authorization": f"Bearer {creds.token}",
-        "Content-Type": "application/json",
-        "User-Agent": get_user_agent(),
-    }
+    request_headers = _get_request_headers(account, creds)
     
     # Send the request
     try:
         if is_streaming:
-            resp = http_requests.post(
+            # The response is closed by the stream generator once consumed
+            request = _async_client.build_request(
+                "POST",
                 target_url,
-                data=json.dumps(final_payload),
+                content=orjson.dumps(final_payload),
                 headers=request_headers,
-                stream=True,
             )
+            resp = await _async_client.send(request, stream=True)
             if resp.status_code == 200:
                 rotator.record_success(account)
             else:
                 rotator.record_error(account, resp.status_code, f"HTTP {resp.status_code}")
-            return _handle_streaming_response(resp)
+            return await _handle_streaming_response(resp)
         else:
-            resp = http_requests.post(
+            resp = await _async_client.post(
                 target_url,
-                data=json.dumps(final_payload),
+                content=orjson.dumps(final_payload),
                 headers=request_headers,
             )
             if resp.status_code == 200:
@@ -227,10 +298,10 @@ def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
                 rotator.record_error(account, resp.status_code, f"HTTP {resp.status_code}")
             return _handle_non_streaming_response(resp)
             
-    except http_requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         rotator.record_error(account, 502, str(e))
         return Response(
-            content=json.dumps({"error": {"message": f"Request failed: {e}"}}),
+            content=orjson.dumps({"error": {"message": f"Request failed: {e}"}}),
             status_code=502,
             media_type="application/json",
         )
@@ -238,9 +309,26 @@ def send_rotated_request(payload: dict, is_streaming: bool = False) -> Response:
 
 # ---- Response handlers (same as google_api_client.py but self-contained) ----
 
-def _handle_streaming_response(resp) -> StreamingResponse:
+def _unwrap_sse_event(line: bytes) -> bytes | None:
+    """
+    Turn an upstream SSE data line into an event with the Code Assist
+    {"response": ...} envelope removed. Returns None for lines that are not
+    valid JSON, which are dropped.
+    """
+    try:
+        obj = loads_json(line[len(_SSE_PREFIX):])
+    except json.JSONDecodeError:
+        return None
+    if isinstance(obj, dict) and "response" in obj:
+        obj = obj["response"]
+    return _SSE_PREFIX + dumps_json(obj) + _SSE_SUFFIX
+
+
+async def _handle_streaming_response(resp: httpx.Response) -> StreamingResponse:
     """Handle streaming response from Google API."""
     if resp.status_code != 200:
+        await resp.aread()
+        await resp.aclose()
         error_message = f"Google API error: {resp.status_code}"
         try:
             error_data = resp.json()
@@ -253,7 +341,7 @@ def _handle_streaming_response(resp) -> StreamingResponse:
             error_response = {
                 "error": {"message": error_message, "type": "api_error", "code": resp.status_code}
             }
-            yield f'data: {json.dumps(error_response)}\n\n'.encode('utf-8')
+            yield _SSE_PREFIX + orjson.dumps(error_response) + _SSE_SUFFIX
         
         return StreamingResponse(
             error_generator(),
@@ -262,42 +350,42 @@ def _handle_streaming_response(resp) -> StreamingResponse:
         )
     
     async def stream_generator():
+        buffer = b""
         try:
-            with resp:
-                for chunk in resp.iter_lines():
-                    if chunk:
-                        if not isinstance(chunk, str):
-                            chunk = chunk.decode('utf-8', 'ignore')
-                        if chunk.startswith('data: '):
-                            chunk = chunk[len('data: '):]
-                            try:
-                                obj = json.loads(chunk)
-                                if "response" in obj:
-                                    response_chunk = obj["response"]
-                                    yield f"data: {json.dumps(response_chunk, separators=(',', ':'))}\n\n".encode('utf-8')
-                                else:
-                                    yield f"data: {json.dumps(obj, separators=(',', ':'))}\n\n".encode('utf-8')
-                                await asyncio.sleep(0)
-                            except json.JSONDecodeError:
-                                continue
+            # Forward raw bytes, one SSE event per yield; chunks may split lines
+            async for data in resp.aiter_bytes():
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.startswith(_SSE_PREFIX):
+                        event = _unwrap_sse_event(line)
+                        if event is not None:
+                            yield event
+            if buffer.startswith(_SSE_PREFIX):
+                event = _unwrap_sse_event(buffer)
+                if event is not None:
+                    yield event
         except Exception as e:
             logger.error(f"Streaming error: {e}")
-            yield f'data: {json.dumps({"error": {"message": str(e), "code": 500}})}\n\n'.encode('utf-8')
+            yield _SSE_PREFIX + orjson.dumps({"error": {"message": str(e), "code": 500}}) + _SSE_SUFFIX
+        finally:
+            await resp.aclose()
     
     return StreamingResponse(stream_generator(), media_type="text/event-stream")
 
 
-def _handle_non_streaming_response(resp) -> Response:
+def _handle_non_streaming_response(resp: httpx.Response) -> Response:
     """Handle non-streaming response from Google API."""
     if resp.status_code == 200:
+        body = resp.content
+        if body.startswith(_SSE_PREFIX):
+            body = body[len(_SSE_PREFIX):]
+        
         try:
-            text = resp.text
-            if text.startswith('data: '):
-                text = text[len('data: '):]
-            parsed = json.loads(text)
+            parsed = loads_json(body)
             content = parsed.get("response", parsed)
             return Response(
-                content=json.dumps(content),
+                content=dumps_json(content),
                 status_code=200,
                 media_type="application/json; charset=utf-8",
             )
@@ -308,7 +396,7 @@ def _handle_non_streaming_response(resp) -> Response:
             error_data = resp.json()
             if "error" in error_data:
                 return Response(
-                    content=json.dumps({"error": error_data["error"]}),
+                    content=dumps_json({"error": error_data["error"]}),
                     status_code=resp.status_code,
                     media_type="application/json",
                 )
@@ -1,6 +1,28 @@
+import functools
+import json
 import platform
+import orjson
 from .config import CLI_VERSION
 
+def loads_json(data):
+    """
+    Parse JSON with orjson, falling back to the stdlib for input orjson rejects
+    but json accepts (e.g. lone surrogate escapes like "\\ud83d").
+    Raises json.JSONDecodeError (orjson's error subclasses it) if both fail.
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+def dumps_json(obj) -> bytes:
+    """Serialize to JSON bytes with orjson, escaping lone surrogates via the stdlib."""
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+@functools.lru_cache(maxsize=None)
 def get_user_agent():
     """Generate User-Agent string matching gemini-cli format."""
     version = CLI_VERSION
@@ -8,6 +30,7 @@ def get_user_agent():
     arch = platform.machine()
     return f"GeminiCLI/{version} ({system}; {arch})"
 
+@functools.lru_cache(maxsize=None)
 def get_platform_string():
     """Generate platform string matching gemini-cli format."""
     system = platform.system().upper()
@@ -0,0 +1,57 @@
+import time
+
+from src.account_rotator import ONBOARDED_CACHE_FILE, ONBOARDED_TTL_SECONDS, AccountRotator, AccountState
+
+
+def _granted_in(account: AccountState, start: float, end: float, gap: float, step: float = 0.1) -> int:
+    granted = 0
+    steps = int(round((end - start) / step))
+    for i in range(steps):
+        if account.try_acquire(gap, start + i * step):
+            granted += 1
+    return granted
+
+
+def test_rate_never_exceeds_max_rpm_per_window():
+    account = AccountState("a@example.com", "a.json", {}, "p", max_rpm=10)
+    assert _granted_in(account, 0.0, 60.0, gap=2.0) == 10
+    assert _granted_in(account, 60.0, 120.0, gap=2.0) == 10
+
+
+def test_no_burst_after_idle():
+    account = AccountState("a@example.com", "a.json", {}, "p", max_rpm=10)
+    assert account.try_acquire(0.0, 0.0)
+    # Ten idle minutes must not be saved up into a burst
+    assert _granted_in(account, 600.0, 660.0, gap=0.0) == 10
+
+
+def test_requests_in_window_counts_recent_grants():
+    account = AccountState("a@example.com", "a.json", {}, "p", max_rpm=10)
+    _granted_in(account, 0.0, 60.0, gap=2.0)
+    assert account.requests_in_window(59.9) == 10
+    assert account.requests_in_window(90.0) == 5
+    assert account.requests_in_window(200.0) == 0
+
+
+def test_onboarded_cache_is_compacted_on_load(tmp_path):
+    now = time.time()
+    expired = now - ONBOARDED_TTL_SECONDS - 1
+    cache = tmp_path / ONBOARDED_CACHE_FILE
+    cache.write_text(
+        f"a@example.com\t{now - 10}\n"
+        f"a@example.com\t{now}\n"
+        f"b@example.com\t{expired}\n"
+        "garbage\n"
+    )
+
+    rotator = AccountRotator(str(tmp_path))
+
+    assert rotator.is_onboarded("a@example.com")
+    assert not rotator.is_onboarded("b@example.com")
+    assert cache.read_text() == f"a@example.com\t{now}\n"
+
+
+def test_onboarded_cache_round_trip(tmp_path):
+    AccountRotator(str(tmp_path)).mark_onboarded("a@example.com")
+    assert AccountRotator(str(tmp_path)).is_onboarded("a@example.com")
+    assert len((tmp_path / ONBOARDED_CACHE_FILE).read_text().splitlines()) == 1
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from src.google_api_client import _handle_streaming_response
+
+
+class _FakeStreamResponse:
+    status_code = 200
+
+    def __init__(self, lines):
+        self._lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+
+def _collect(lines):
+    async def run():
+        response = _handle_streaming_response(_FakeStreamResponse(lines))
+        return [chunk async for chunk in response.body_iterator]
+    return asyncio.run(run())
+
+
+def test_stream_unwraps_response():
+    events = _collect([b'data: {"response": {"a": 1}}', b"", b'data: {"b": 2}'])
+    assert events == [b'data: {"a":1}\n\n', b'data: {"b":2}\n\n']
+
+
+def test_stream_keeps_going_after_lone_surrogate():
+    events = _collect([b'data: {"response": {"text": "\\ud83d"}}', b'data: {"response": {"a": 1}}'])
+    assert len(events) == 2
+    assert json.loads(events[0][len(b"data: "):]) == {"text": "\ud83d"}
+    assert events[1] == b'data: {"a":1}\n\n'
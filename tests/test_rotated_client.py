@@ -0,0 +1,81 @@
+import json
+
+import httpx
+
+from src import rotated_client
+from src.account_rotator import AccountRotator
+from src.rotated_client import _handle_non_streaming_response, _unwrap_sse_event
+
+
+def _non_streaming_body(content: bytes) -> bytes:
+    return _handle_non_streaming_response(httpx.Response(200, content=content)).body
+
+
+def test_non_streaming_envelope_with_extra_field():
+    body = _non_streaming_body(b'{"response": {"a": 1}, "metadata": {"x":1}}')
+    assert json.loads(body) == {"a": 1}
+
+
+def test_non_streaming_envelope_with_trace_id_first():
+    body = _non_streaming_body(b'{"traceId": "x", "response": {"a": [1, 2]}}')
+    assert json.loads(body) == {"a": [1, 2]}
+
+
+def test_non_streaming_envelope_with_trace_id_last():
+    body = _non_streaming_body(b'{"response": {"a": 1}, "traceId": "x"}')
+    assert json.loads(body) == {"a": 1}
+
+
+def _sse_payload(event: bytes) -> dict:
+    assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+    return json.loads(event[len(b"data: "):])
+
+
+def test_sse_event_unwrapped():
+    event = _unwrap_sse_event(b'data: {"response": {"candidates": []}, "traceId": "x"}\r')
+    assert event == b'data: {"candidates":[]}\n\n'
+
+
+def test_sse_event_with_extra_field():
+    event = _unwrap_sse_event(b'data: {"response": {"candidates": [1]}, "meta": {"x": 1}}')
+    assert _sse_payload(event) == {"candidates": [1]}
+
+
+def test_sse_event_with_trace_id_first():
+    event = _unwrap_sse_event(b'data: {"traceId": "x", "response": {"candidates": [1]}}')
+    assert _sse_payload(event) == {"candidates": [1]}
+
+
+def test_sse_event_without_envelope():
+    assert _unwrap_sse_event(b'data: {"error": {"code": 1}}') == b'data: {"error":{"code":1}}\n\n'
+
+
+def test_sse_event_invalid_json_dropped():
+    assert _unwrap_sse_event(b"data: {not json") is None
+
+
+def test_sse_event_with_lone_surrogate():
+    event = _unwrap_sse_event(b'data: {"traceId":"x","response":{"t":"\\ud83d"}}')
+    assert _sse_payload(event) == {"t": "\ud83d"}
+
+
+def test_non_streaming_envelope_with_lone_surrogate():
+    response = _handle_non_streaming_response(
+        httpx.Response(200, content=b'{"traceId":"x","response":{"t":"\\ud83d"}}')
+    )
+    assert response.media_type == "application/json; charset=utf-8"
+    assert json.loads(response.body) == {"t": "\ud83d"}
+
+
+def test_warm_up_failure_keeps_account_in_rotation(tmp_path, monkeypatch):
+    (tmp_path / "a_at_example_com.json").write_text('{"refresh_token": "r"}')
+    rotator = AccountRotator(str(tmp_path), 10, 1)
+    monkeypatch.setattr(rotated_client, "get_rotator", lambda: rotator)
+    monkeypatch.setattr(rotated_client, "_get_google_credentials", lambda account: None)
+
+    rotated_client.warm_up_accounts()
+
+    account = rotator.accounts[0]
+    assert account.is_healthy
+    assert account.consecutive_errors == 1
+    assert rotator.get_next_account() is account